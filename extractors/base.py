@@ -1,21 +1,29 @@
+import contextlib
 import torch
+import torch.nn.functional as F
 from models import vision_transformer as vit
 
 
-def attn_cosine_sim(x, eps=1e-08):
-    x = x[0]
-    norm1 = x.norm(dim=2, keepdim=True)
-    factor = torch.clamp(norm1 @ norm1.permute(0, 2, 1), min=eps)
-    sim_matrix = (x @ x.permute(0, 2, 1)) / factor
+def _fuse(fn):
+    if hasattr(torch, 'compile'):
+        return fn
+    return torch.jit.script(fn)
+
+
+def _normalize(x: torch.Tensor, eps: float):
+    return x * torch.rsqrt((x * x).sum(dim=-1, keepdim=True).clamp_min(eps * eps))
+
+
+@_fuse
+def attn_cosine_sim(x: torch.Tensor, eps: float = 1e-08):  # [N, D] -> [N, N]
+    xn = _normalize(x, eps)
+    sim_matrix = xn @ xn.transpose(-1, -2)
     return sim_matrix
 
 
-def cross_cos_sim(x, y, eps=1e-08):
-    x, y = x[0], y[0]
-    norm_x = x.norm(dim=2, keepdim=True)
-    norm_y = y.norm(dim=2, keepdim=True)
-    factor = torch.clamp(norm_x @ norm_y.permute(0, 2, 1), min=eps)
-    cross_sim_matrix = (x @ y.permute(0, 2, 1)) / factor
+@_fuse
+def cross_cos_sim(x: torch.Tensor, y: torch.Tensor, eps: float = 1e-08):  # [N, D], [N, D] -> [N, N]
+    cross_sim_matrix = _normalize(x, eps) @ _normalize(y, eps).transpose(-1, -2)
     return cross_sim_matrix
 
 
@@ -27,98 +35,173 @@ class VitExtractor:
     KEY_LIST = [BLOCK_KEY, ATTN_KEY, PATCH_IMD_KEY, QKV_KEY]
     MODE = {'small': vit.vit_small, 'base': vit.vit_base, 'tiny': vit.vit_tiny}
 
-    def __init__(self, mode, patch_size, pretrained=None, device='cuda'):
+    def __init__(self, mode, patch_size, pretrained=None, device='cuda', dtype=torch.bfloat16, compile_model=False):
         self.device = device
+        self.dtype = dtype
         self.mode = mode
         self.patch_size = patch_size
         self.model = VitExtractor.MODE[mode](patch_size=patch_size)
         if pretrained is not None:
             print(f'load pretrained model from {pretrained}.')
             self.load(pretrained=pretrained)
-        self.model.eval().to(device)
+        self.embedding_dim = self.model.embed_dim
+        self.head_num = self.model.blocks[0].attn.num_heads
+        self.head_dim = self.embedding_dim // self.head_num
+        self.model.eval().to(device=device, dtype=dtype)
 
-        self.hook_handlers = []
         self.layers_dict = {}
-        self.outputs_dict = {}
-        for key in VitExtractor.KEY_LIST:
-            self.layers_dict[key] = []
-            self.outputs_dict[key] = []
-        self._init_hooks_data()
+        self._active_layers = {}
+        self._init_layers()
+        self._sdpa_layers = self._get_sdpa_layers()
+        self._capture_forward = self._forward_capture
+        self._compiled_forwards = {}
+        self._attn_cosine_sim = attn_cosine_sim
+        self._cross_cos_sim = cross_cos_sim
+        if compile_model:
+            self._compile_model()
+        self._caching = False
+        self._feature_cache = {}
+        self._named_cache = {}
 
     def load(self, pretrained):
         raise NotImplementedError
 
-    def _init_hooks_data(self):
-        self.layers_dict[VitExtractor.BLOCK_KEY] = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
-        self.layers_dict[VitExtractor.ATTN_KEY] = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
-        self.layers_dict[VitExtractor.QKV_KEY] = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
-        self.layers_dict[VitExtractor.PATCH_IMD_KEY] = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+    def _compile_model(self):
+        if not hasattr(torch, 'compile'):
+            print('torch.compile requires torch >= 2.0, running the extractor eagerly.')
+            return
+        self._capture_forward = self._compiled_capture_forward
+        # `reduce-overhead` is avoided since its CUDA graphs overwrite the outputs that the losses keep across calls
+        self._attn_cosine_sim = torch.compile(attn_cosine_sim, dynamic=True)
+        self._cross_cos_sim = torch.compile(cross_cos_sim, dynamic=True)
+
+    def _init_layers(self):
         for key in VitExtractor.KEY_LIST:
-            self.outputs_dict[key] = []
+            self.layers_dict[key] = set()
+            self._active_layers[key] = set()
 
-    def _register_hooks(self, **kwargs):
+    def select_layers(self, keys, layers):
+        for key in VitExtractor.KEY_LIST:
+            self.layers_dict[key] = set(layers) if key in keys else set()
+
+    def _get_sdpa_layers(self):
+        if not hasattr(F, 'scaled_dot_product_attention'):
+            return set()
+        return {block_idx for block_idx, block in enumerate(self.model.blocks)
+                if block.attn.scale == (block.attn.qkv.in_features // block.attn.num_heads) ** -0.5}
+
+    def _attention(self, attn, qkv, block_idx, need_weights):
+        B, N, C = qkv.shape[0], qkv.shape[1], qkv.shape[2] // 3
+        q, k, v = qkv.reshape(B, N, 3, attn.num_heads, C // attn.num_heads).permute(2, 0, 3, 1, 4).unbind(0)
+        if need_weights or block_idx not in self._sdpa_layers:
+            weights = attn.attn_drop(((q @ k.transpose(-2, -1)) * attn.scale).softmax(dim=-1))
+            x = weights @ v
+        else:
+            weights, x = None, F.scaled_dot_product_attention(q, k, v)
+        x = attn.proj_drop(attn.proj(x.transpose(1, 2).reshape(B, N, C)))
+        return x, weights
+
+    def _compiled_capture_forward(self, input_img, active):
+        selection = tuple(frozenset(active[key]) for key in VitExtractor.KEY_LIST)
+        if selection not in self._compiled_forwards:
+            layers = dict(zip(VitExtractor.KEY_LIST, selection))
+            self._compiled_forwards[selection] = torch.compile(lambda img: self._forward_capture(img, layers),
+                                                               mode='max-autotune')
+        if input_img.shape[0] > 1:
+            torch._dynamo.mark_dynamic(input_img, 0)
+        return self._compiled_forwards[selection](input_img)
+
+    def _forward_capture(self, input_img, active):
+        last_layer = max(max(layers, default=-1) for layers in active.values())
+        outputs = {}
+        x = self.model.prepare_tokens(input_img)
         for block_idx, block in enumerate(self.model.blocks):
-            if block_idx in self.layers_dict[VitExtractor.BLOCK_KEY]:
-                self.hook_handlers.append(block.register_forward_hook(self._get_block_hook()))
-            if block_idx in self.layers_dict[VitExtractor.ATTN_KEY]:
-                self.hook_handlers.append(block.attn.attn_drop.register_forward_hook(self._get_attn_hook()))
-            if block_idx in self.layers_dict[VitExtractor.QKV_KEY]:
-                self.hook_handlers.append(block.attn.qkv.register_forward_hook(self._get_qkv_hook()))
-            if block_idx in self.layers_dict[VitExtractor.PATCH_IMD_KEY]:
-                self.hook_handlers.append(block.attn.register_forward_hook(self._get_patch_imd_hook()))
-
-    def _clear_hooks(self):
-        for handler in self.hook_handlers:
-            handler.remove()
-        self.hook_handlers = []
-
-    def _get_block_hook(self):
-        def _get_block_output(model, input, output):
-            self.outputs_dict[VitExtractor.BLOCK_KEY].append(output)
-
-        return _get_block_output
-
-    def _get_attn_hook(self):
-        def _get_attn_output(model, inp, output):
-            self.outputs_dict[VitExtractor.ATTN_KEY].append(output)
-
-        return _get_attn_output
-
-    def _get_qkv_hook(self):
-        def _get_qkv_output(model, inp, output):
-            self.outputs_dict[VitExtractor.QKV_KEY].append(output)
-
-        return _get_qkv_output
-
-    def _get_patch_imd_hook(self):
-        def _get_attn_output(model, inp, output):
-            self.outputs_dict[VitExtractor.PATCH_IMD_KEY].append(output[0])
-
-        return _get_attn_output
-
-    def get_feature_from_input(self, input_img):  # List([B, N, D])
-        self._register_hooks()
-        self.model(input_img)
-        feature = self.outputs_dict[VitExtractor.BLOCK_KEY]
-        self._clear_hooks()
-        self._init_hooks_data()
-        return feature
-
-    def get_qkv_feature_from_input(self, input_img):
-        self._register_hooks()
-        self.model(input_img)
-        feature = self.outputs_dict[VitExtractor.QKV_KEY]
-        self._clear_hooks()
-        self._init_hooks_data()
-        return feature
-
-    def get_attn_feature_from_input(self, input_img):
-        self._register_hooks()
-        self.model(input_img)
-        feature = self.outputs_dict[VitExtractor.ATTN_KEY]
-        self._clear_hooks()
-        self._init_hooks_data()
-        return feature
+            if block_idx > last_layer:
+                break
+            qkv = block.attn.qkv(block.norm1(x))
+            y, weights = self._attention(block.attn, qkv, block_idx, block_idx in active[VitExtractor.ATTN_KEY])
+            x = x + block.drop_path(y)
+            x = x + block.drop_path(block.mlp(block.norm2(x)))
+            for key, output in ((VitExtractor.QKV_KEY, qkv), (VitExtractor.ATTN_KEY, weights),
+                                (VitExtractor.PATCH_IMD_KEY, y), (VitExtractor.BLOCK_KEY, x)):
+                if block_idx in active[key]:
+                    outputs[(key, block_idx)] = output
+        return outputs
+
+    @staticmethod
+    def _cache_key(input_img, requires_grad):
+        # requires_grad is part of the key so that features extracted without graph are never reused by a loss term
+        return (input_img.data_ptr(), tuple(input_img.shape), input_img.stride(), input_img._version, requires_grad)
+
+    def clear_feature_cache(self):
+        self._feature_cache = {}
+
+    @contextlib.contextmanager
+    def step(self):
+        self._caching = True
+        try:
+            yield self
+        finally:
+            self._caching = False
+            self.clear_feature_cache()
+
+    def _get_cached_outputs(self, input_img, requires_grad, cache_key):
+        if cache_key is not None:
+            cached_img = self._named_cache[cache_key][0] if cache_key in self._named_cache else None
+            if cached_img is None or cached_img.shape != input_img.shape or not torch.equal(cached_img, input_img):
+                self._named_cache[cache_key] = (input_img.detach().clone(), {})
+            return self._named_cache[cache_key][1]
+        if not self._caching:
+            return {}
+        step_key = self._cache_key(input_img, requires_grad)
+        if step_key not in self._feature_cache:
+            # keep a reference to the input so that its memory (and thus the key) is not recycled while cached
+            self._feature_cache[step_key] = (input_img, {})
+        return self._feature_cache[step_key][1]
+
+    def _run_model(self, input_img, requires_grad):
+        with torch.set_grad_enabled(requires_grad):
+            captured = self._capture_forward(input_img.to(self.dtype), self._active_layers)
+        return {k: output.float() for k, output in captured.items()}
+
+    def _get_outputs_from_input(self, input_img, key, layers, requires_grad=None, cache_key=None):
+        if cache_key is not None:
+            requires_grad = False
+        requires_grad = torch.is_grad_enabled() if requires_grad is None else requires_grad
+        outputs = self._get_cached_outputs(input_img, requires_grad, cache_key)
+        missing = [layer for layer in layers if (key, layer) not in outputs]
+        if missing:
+            for k in VitExtractor.KEY_LIST:
+                self._active_layers[k] = {layer for layer in self.layers_dict[k] if (k, layer) not in outputs}
+            self._active_layers[key].update(missing)
+            outputs.update(self._run_model(input_img, requires_grad))
+        return [outputs[(key, layer)] for layer in layers]
+
+    def extract_batched(self, imgs, requires_grad=None):
+        requires_grad = torch.is_grad_enabled() if requires_grad is None else requires_grad
+        for k in VitExtractor.KEY_LIST:
+            self._active_layers[k] = set(self.layers_dict[k])
+        outputs = self._run_model(torch.cat(imgs, dim=0), requires_grad)
+        batch_sizes = [img.shape[0] for img in imgs]
+        cached_outputs = [self._get_cached_outputs(img, requires_grad, None) for img in imgs]
+        for output_key, output in outputs.items():
+            for cached, output_slice in zip(cached_outputs, output.split(batch_sizes)):
+                cached[output_key] = output_slice
+
+    def _get_layer_output_from_input(self, input_img, key, layer_num, cache_key=None):
+        return self._get_outputs_from_input(input_img, key, [layer_num], cache_key=cache_key)[0]
+
+    def get_feature_from_input(self, input_img, requires_grad=False):  # List([B, N, D])
+        return self._get_outputs_from_input(input_img, VitExtractor.BLOCK_KEY, range(len(self.model.blocks)),
+                                            requires_grad=requires_grad)
+
+    def get_qkv_feature_from_input(self, input_img, requires_grad=False):
+        return self._get_outputs_from_input(input_img, VitExtractor.QKV_KEY, range(len(self.model.blocks)),
+                                            requires_grad=requires_grad)
+
+    def get_attn_feature_from_input(self, input_img, requires_grad=False):
+        return self._get_outputs_from_input(input_img, VitExtractor.ATTN_KEY, range(len(self.model.blocks)),
+                                            requires_grad=requires_grad)
 
     def get_patch_size(self):
         return self.patch_size
@@ -138,95 +221,104 @@ class VitExtractor:
         return patch_num
 
     def get_head_num(self):
-        return 6 if self.mode == 'small' else 12
+        return self.head_num
 
     def get_embedding_dim(self):
-        return 384 if self.mode == 'small' else 768
-
-    def get_queries_from_qkv(self, qkv, input_img_shape):
-        patch_num = self.get_patch_num(input_img_shape)
-        head_num = self.get_head_num()
-        embedding_dim = self.get_embedding_dim()
-        q = qkv.reshape(patch_num, 3, head_num, embedding_dim // head_num).permute(1, 2, 0, 3)[0]
-        return q
-
-    def get_keys_from_qkv(self, qkv, input_img_shape):
-        patch_num = self.get_patch_num(input_img_shape)
-        head_num = self.get_head_num()
-        embedding_dim = self.get_embedding_dim()
-        k = qkv.reshape(patch_num, 3, head_num, embedding_dim // head_num).permute(1, 2, 0, 3)[1]
-        return k
-
-    def get_values_from_qkv(self, qkv, input_img_shape):
-        patch_num = self.get_patch_num(input_img_shape)
-        head_num = self.get_head_num()
-        embedding_dim = self.get_embedding_dim()
-        v = qkv.reshape(patch_num, 3, head_num, embedding_dim // head_num).permute(1, 2, 0, 3)[2]
-        return v
-
-    def get_keys_from_input(self, input_img, layer_num):
-        qkv_features = self.get_qkv_feature_from_input(input_img)[layer_num]
-        keys = self.get_keys_from_qkv(qkv_features, input_img.shape)
+        return self.embedding_dim
+
+    def get_qkv_split(self, qkv):  # 3 x [H, N, D/H]
+        patch_num = qkv.shape[-2]
+        q, k, v = qkv.reshape(patch_num, 3, self.head_num, self.head_dim).permute(1, 2, 0, 3).unbind(0)
+        return q, k, v
+
+    def get_queries_from_qkv(self, qkv, input_img_shape=None):
+        return self.get_qkv_split(qkv)[0]
+
+    def get_keys_from_qkv(self, qkv, input_img_shape=None):
+        return self.get_qkv_split(qkv)[1]
+
+    def get_values_from_qkv(self, qkv, input_img_shape=None):
+        return self.get_qkv_split(qkv)[2]
+
+    def get_keys_from_input(self, input_img, layer_num, cache_key=None):
+        qkv_features = self._get_layer_output_from_input(input_img, VitExtractor.QKV_KEY, layer_num, cache_key)
+        keys = self.get_keys_from_qkv(qkv_features)
         # print(keys.shape)
         return keys
 
-    def get_values_from_input(self, input_img, layer_num):
-        qkv_features = self.get_qkv_feature_from_input(input_img)[layer_num]
-        values = self.get_values_from_qkv(qkv_features, input_img.shape)
+    def get_values_from_input(self, input_img, layer_num, cache_key=None):
+        qkv_features = self._get_layer_output_from_input(input_img, VitExtractor.QKV_KEY, layer_num, cache_key)
+        values = self.get_values_from_qkv(qkv_features)
         return values
 
-    def get_queries_from_input(self, input_img, layer_num):
-        qkv_features = self.get_qkv_feature_from_input(input_img)[layer_num]
-        queries = self.get_queries_from_qkv(qkv_features, input_img.shape)
+    def get_queries_from_input(self, input_img, layer_num, cache_key=None):
+        qkv_features = self._get_layer_output_from_input(input_img, VitExtractor.QKV_KEY, layer_num, cache_key)
+        queries = self.get_queries_from_qkv(qkv_features)
         return queries
 
-    def get_tokens_from_input(self, input_img, layer_num):
-        tokens = self.get_feature_from_input(input_img)[layer_num]
+    def get_tokens_from_input(self, input_img, layer_num, cache_key=None):
+        tokens = self._get_layer_output_from_input(input_img, VitExtractor.BLOCK_KEY, layer_num, cache_key)
         return tokens
 
-    def get_keys_self_sim_from_input(self, input_img, layer_num):
-        keys = self.get_keys_from_input(input_img, layer_num=layer_num)
-        h, t, d = keys.shape
-        concatenated_keys = keys.transpose(0, 1).reshape(t, h * d)
-        ssim_map = attn_cosine_sim(concatenated_keys[None, None, ...])
+    def _get_concatenated_heads_from_qkv(self, qkv, index):  # [N, D]
+        return qkv.reshape(qkv.shape[-2], 3, self.embedding_dim)[:, index]
+
+    def get_keys_self_sim_from_qkv(self, qkv):
+        keys = self._get_concatenated_heads_from_qkv(qkv, 1)
+        ssim_map = self._attn_cosine_sim(keys)
         return ssim_map
 
-    def get_values_self_sim_from_input(self, input_img, layer_num):
-        values = self.get_values_from_input(input_img, layer_num=layer_num)
-        h, t, d = values.shape
-        concatenated_values = values.transpose(0, 1).reshape(t, h * d)
-        ssim_map = attn_cosine_sim(concatenated_values[None, None, ...])
+    def get_values_self_sim_from_qkv(self, qkv):
+        values = self._get_concatenated_heads_from_qkv(qkv, 2)
+        ssim_map = self._attn_cosine_sim(values)
         return ssim_map
 
-    def get_queries_self_sim_from_input(self, input_img, layer_num):
-        queries = self.get_queries_from_input(input_img, layer_num=layer_num)
-        h, t, d = queries.shape
-        concatenated_values = queries.transpose(0, 1).reshape(t, h * d)
-        ssim_map = attn_cosine_sim(concatenated_values[None, None, ...])
+    def get_queries_self_sim_from_qkv(self, qkv):
+        queries = self._get_concatenated_heads_from_qkv(qkv, 0)
+        ssim_map = self._attn_cosine_sim(queries)
         return ssim_map
 
-    def get_tokens_self_sim_from_input(self, input_img, layer_num):
-        tokens = self.get_tokens_from_input(input_img, layer_num=layer_num)
+    def get_keys_self_sim_from_input(self, input_img, layer_num, cache_key=None):
+        qkv_features = self._get_layer_output_from_input(input_img, VitExtractor.QKV_KEY, layer_num, cache_key)
+        return self.get_keys_self_sim_from_qkv(qkv_features)
+
+    def get_values_self_sim_from_input(self, input_img, layer_num, cache_key=None):
+        qkv_features = self._get_layer_output_from_input(input_img, VitExtractor.QKV_KEY, layer_num, cache_key)
+        return self.get_values_self_sim_from_qkv(qkv_features)
+
+    def get_queries_self_sim_from_input(self, input_img, layer_num, cache_key=None):
+        qkv_features = self._get_layer_output_from_input(input_img, VitExtractor.QKV_KEY, layer_num, cache_key)
+        return self.get_queries_self_sim_from_qkv(qkv_features)
+
+    def get_tokens_self_sim_from_input(self, input_img, layer_num, cache_key=None):
+        tokens = self.get_tokens_from_input(input_img, layer_num=layer_num, cache_key=cache_key)
         h, t, d = tokens.shape
         concatenated_values = tokens.transpose(0, 1).reshape(t, h * d)
-        ssim_map = attn_cosine_sim(concatenated_values[None, None, ...])
+        ssim_map = self._attn_cosine_sim(concatenated_values)
         return ssim_map
 
-    def get_attentions_from_input(self, input_img, layer_num, return_mean=True):
-        attn_output_weights = self.get_attn_feature_from_input(input_img)[layer_num]
-        attn_output_weights_mean = attn_output_weights.sum(dim=1) / self.get_head_num()
-        return attn_output_weights, attn_output_weights_mean if return_mean else None
+    def get_attentions_from_input(self, input_img, layer_num, return_mean=True, cache_key=None):
+        attn_output_weights = self._get_layer_output_from_input(input_img, VitExtractor.ATTN_KEY, layer_num,
+                                                                cache_key)
+        attn_output_weights_mean = attn_output_weights.mean(dim=1) if return_mean else None
+        return attn_output_weights, attn_output_weights_mean
 
-    def get_keys_cross_sim_from_input(self, source_img, target_img, layer_num):
-        src_keys = self.get_keys_from_input(source_img, layer_num=layer_num)
-        tgt_keys = self.get_keys_from_input(target_img, layer_num=layer_num)
+    def get_keys_cross_sim_from_qkv(self, src_qkv, tgt_qkv):
+        src_keys = self._get_concatenated_heads_from_qkv(src_qkv, 1)
+        tgt_keys = self._get_concatenated_heads_from_qkv(tgt_qkv, 1)
         assert src_keys.shape == tgt_keys.shape
-        h, t, d = src_keys.shape
-        concatenated_src_keys = src_keys.transpose(0, 1).reshape(t, h*d)
-        concatenated_tgt_keys = tgt_keys.transpose(0, 1).reshape(t, h*d)
-        cross_sim_map = cross_cos_sim(concatenated_src_keys[None, None, ...], concatenated_tgt_keys[None, None, ...])
+        cross_sim_map = self._cross_cos_sim(src_keys, tgt_keys)
         return cross_sim_map
 
-    def get_cls_token_from_input(self, input_img, layer_num):
-        cls = self.get_feature_from_input(input_img)[layer_num][:, 0, :]
+    def get_keys_cross_sim_from_input(self, source_img, target_img, layer_num):
+        assert source_img.shape == target_img.shape
+        src_qkv = self._get_layer_output_from_input(source_img, VitExtractor.QKV_KEY, layer_num)
+        if target_img is source_img:
+            tgt_qkv = src_qkv
+        else:
+            tgt_qkv = self._get_layer_output_from_input(target_img, VitExtractor.QKV_KEY, layer_num)
+        return self.get_keys_cross_sim_from_qkv(src_qkv, tgt_qkv)
+
+    def get_cls_token_from_input(self, input_img, layer_num, cache_key=None):
+        cls = self._get_layer_output_from_input(input_img, VitExtractor.BLOCK_KEY, layer_num, cache_key)[:, 0, :]
         return cls
@@ -1,4 +1,5 @@
 import clip
+import torch
 from .base import VitExtractor
 
 
@@ -10,5 +11,7 @@ class CLIPVitExtractor(VitExtractor):
         self.model = model.visual
 
     def __init__(self, mode='base', patch_size=16,
-                 pretrained='./checkpoints/clip_vitbase16_pretrain.pt', device='cuda'):
-        super().__init__(mode=mode, patch_size=patch_size, pretrained=pretrained, device=device)
+                 pretrained='./checkpoints/clip_vitbase16_pretrain.pt', device='cuda', dtype=torch.bfloat16,
+                 compile_model=False):
+        super().__init__(mode=mode, patch_size=patch_size, pretrained=pretrained, device=device, dtype=dtype,
+                         compile_model=compile_model)
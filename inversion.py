@@ -39,7 +39,7 @@ def init():
     image = load_image(args.target).to(device)
     save_image(image, os.path.join(output_dir, 'target.png'))
 
-    vit_extractor = load_extractor(args.vit, args.mode, args.patch_size, device)
+    vit_extractor = load_extractor(args.vit, args.mode, args.patch_size, device, args.vit_dtype, args.compile)
 
     get_features = {
         'keys': vit_extractor.get_keys_from_input,
@@ -22,6 +22,7 @@ parser.add_argument("--model_name", type=str, default='clip',
                     help='DINO: dino base 8; CLIP: clip base 16')
 parser.add_argument('--model_mode', type=str, default='base')
 parser.add_argument('--model_patch', type=int, default=16)
+parser.add_argument('--model_dtype', type=str, default='bfloat16', help='float32, float16 or bfloat16')
 parser.add_argument("--save_path", type=str, default='./outputs/pca')
 
 args = parser.parse_args()
@@ -34,7 +35,8 @@ preprocess = T.Compose([
     T.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
 ])
 # load vit extractor
-vit_extractor = load_extractor(vit=args.model_name, mode=args.model_mode, patch_size=args.model_patch, device=device)
+vit_extractor = load_extractor(vit=args.model_name, mode=args.model_mode, patch_size=args.model_patch, device=device,
+                               dtype=args.model_dtype)
 
 modes = args.facets.split(',')
 layers = [int(i) for i in args.layers.split(',')]
@@ -48,24 +50,28 @@ input_img = T.Compose([
     T.ToTensor()
 ])(input_img).unsqueeze(0).to(device)
 
+with torch.no_grad():
+    input_img_ = preprocess(input_img)
+    qkv_features = vit_extractor.get_qkv_feature_from_input(input_img_)
+
 for mode in tqdm.tqdm(modes):
     for layer in layers:
         # calculate self-sim
         ssim = {
-            'k': vit_extractor.get_keys_self_sim_from_input,
-            'q': vit_extractor.get_queries_self_sim_from_input,
-            'v': vit_extractor.get_values_self_sim_from_input,
-            't': vit_extractor.get_tokens_self_sim_from_input
+            'k': vit_extractor.get_keys_self_sim_from_qkv,
+            'q': vit_extractor.get_queries_self_sim_from_qkv,
+            'v': vit_extractor.get_values_self_sim_from_qkv,
         }
 
         with torch.no_grad():
-            input_img_ = preprocess(input_img)
-            self_sim = ssim[mode](input_img_, layer)
-            cross_sim = vit_extractor.get_keys_cross_sim_from_input(input_img_, input_img_, layer)
+            if mode == 't':
+                self_sim = vit_extractor.get_tokens_self_sim_from_input(input_img_, layer)
+            else:
+                self_sim = ssim[mode](qkv_features[layer])
 
         pca = PCA(n_components=3)
-        pca.fit(self_sim[0].cpu().numpy())
-        components = pca.transform(self_sim[0].cpu().numpy())
+        pca.fit(self_sim.cpu().numpy())
+        components = pca.transform(self_sim.cpu().numpy())
 
         patch_h_num = vit_extractor.get_height_patch_num(input_img.shape)
         patch_w_num = vit_extractor.get_width_patch_num(input_img.shape)
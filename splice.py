@@ -41,7 +41,7 @@ def init():
     image = {'src': source, 'tgt': target}
 
     transform = Transform(batch=args.batch)
-    extractor = load_extractor(args.vit, args.mode, args.patch_size, device)
+    extractor = load_extractor(args.vit, args.mode, args.patch_size, device, args.vit_dtype, args.compile)
 
     return {'args': args, 'transform': transform, 'image': image, 'extractor': extractor}
 
@@ -63,7 +63,7 @@ def train(args, transform, image, extractor):
                                                                          loss_dict['id'], loss_dict['loss'])
 
         if i % args.add_raw_each == 0:
-            _ = trainer(target, source, args.layer)
+            _ = trainer(target, source, args.layer, fixed=True)
 
         if i % args.save_each_iter == 0:
             trainer.save_model(os.path.join(args.output_dir, 'temp', f'{i}'.zfill(4)+'.pt'))
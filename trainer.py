@@ -20,49 +20,65 @@ class Trainer(nn.Module):
         y = self.transformer.vit_transform(x)
         return y
 
-    def app_loss(self, target, predict, layer=11):
+    @staticmethod
+    def _image_cache_key(cache_key, index):
+        return None if cache_key is None else f'{cache_key}_{index}'
+
+    def app_loss(self, target, predict, layer=11, cache_key=None):
         loss, batch = 0., target.shape[0]
 
-        for tgt, pre in zip(self.transform(target), self.transform(predict)):
+        for i, (tgt, pre) in enumerate(zip(target.split(1), predict.split(1))):
+            tgt_key = self._image_cache_key(cache_key, i)
             with torch.no_grad():
-                cls_target = self.extractor.get_cls_token_from_input(tgt.unsqueeze(0), layer)
-            cls_predict = self.extractor.get_cls_token_from_input(pre.unsqueeze(0), layer)
+                cls_target = self.extractor.get_cls_token_from_input(tgt, layer, cache_key=tgt_key)
+            cls_predict = self.extractor.get_cls_token_from_input(pre, layer)
             loss += F.mse_loss(cls_target, cls_predict)
 
         return loss / batch
 
-    def struct_loss(self, target, predict, layer=11):
+    def struct_loss(self, target, predict, layer=11, cache_key=None):
         loss, batch = 0., target.shape[0]
 
-        for tgt, pre in zip(self.transform(target), self.transform(predict)):
+        for i, (tgt, pre) in enumerate(zip(target.split(1), predict.split(1))):
+            tgt_key = self._image_cache_key(cache_key, i)
             with torch.no_grad():
-                struct_target = self.extractor.get_keys_self_sim_from_input(tgt.unsqueeze(0), layer)
-            struct_predict = self.extractor.get_keys_self_sim_from_input(pre.unsqueeze(0), layer)
+                struct_target = self.extractor.get_keys_self_sim_from_input(tgt, layer, cache_key=tgt_key)
+            struct_predict = self.extractor.get_keys_self_sim_from_input(pre, layer)
             loss += F.mse_loss(struct_target, struct_predict)
 
         return loss / batch
 
-    def id_loss(self, target, predict, layer=11):
+    def id_loss(self, target, predict, layer=11, cache_key=None):
         loss, batch = 0., target.shape[0]
 
-        for tgt, pre in zip(self.transform(target), self.transform(predict)):
+        for i, (tgt, pre) in enumerate(zip(target.split(1), predict.split(1))):
+            tgt_key = self._image_cache_key(cache_key, i)
             with torch.no_grad():
-                id_target = self.extractor.get_keys_from_input(tgt.unsqueeze(0), layer)
-            id_predict = self.extractor.get_keys_from_input(pre.unsqueeze(0), layer)
+                id_target = self.extractor.get_keys_from_input(tgt, layer, cache_key=tgt_key)
+            id_predict = self.extractor.get_keys_from_input(pre, layer)
             loss += F.mse_loss(id_target, id_predict)
 
         return loss / batch
 
-    def forward(self, tgt, src, layer):
-
+    def forward(self, tgt, src, layer, fixed=False):
         tgt_predict = self.generator(tgt)
         src_predict = self.generator(src)
 
         self.optimizer.zero_grad()
 
-        loss_app = self.app_loss(tgt, src_predict, layer=layer) * self.app_wt
-        loss_struct = self.struct_loss(src, src_predict, layer=layer) * self.struct_wt
-        loss_id = self.id_loss(tgt, tgt_predict, layer=layer) * self.id_wt
+        tgt, src = self.transform(tgt), self.transform(src)
+        tgt_predict, src_predict = self.transform(tgt_predict), self.transform(src_predict)
+        self.extractor.select_layers([self.extractor.BLOCK_KEY, self.extractor.QKV_KEY], [layer])
+        with self.extractor.step():
+            if not fixed:
+                with torch.no_grad():
+                    self.extractor.extract_batched([*tgt.split(1), *src.split(1)])
+            self.extractor.extract_batched([*tgt_predict.split(1), *src_predict.split(1)])
+
+            tgt_key, src_key = ('target', 'source') if fixed else (None, None)
+            loss_app = self.app_loss(tgt, src_predict, layer=layer, cache_key=tgt_key) * self.app_wt
+            loss_struct = self.struct_loss(src, src_predict, layer=layer, cache_key=src_key) * self.struct_wt
+            loss_id = self.id_loss(tgt, tgt_predict, layer=layer, cache_key=tgt_key) * self.id_wt
         loss = loss_app + loss_struct + loss_id
         loss.backward()
         loss_dict = {'app': loss_app, 'struct': loss_struct, 'id': loss_id, 'loss': loss}
@@ -25,6 +25,10 @@ def config(name='exp'):
     parser.add_argument('--vit', type=str, default='dino', help='vit model: dino or clip. Default is dino.')
     parser.add_argument('--mode', type=str, default='base', help='vit mode: base, small or tiny. Default is base.')
     parser.add_argument('--patch_size', type=int, default=8, help='vit patch size. Default is 8 for dino, 16 for clip.')
+    parser.add_argument('--vit_dtype', type=str, default='bfloat16',
+                        help='vit precision: float32, float16 or bfloat16. Default is bfloat16.')
+    parser.add_argument('--compile', type=str2bool, default=False,
+                        help='compile the vit with torch.compile (torch >= 2.0). Default is False.')
     parser.add_argument('--layer', type=int, default=11, help='use the features from layer. Default is 11 (the last).')
     parser.add_argument('--facet', type=str, default='Keys',
                         help='vit facet: keys, values, queries, tokens. Default is keys.')
@@ -97,10 +101,11 @@ class Transform:
         return image
 
 
-def load_extractor(vit: str, mode: str, patch_size: int, device='cuda'):
+def load_extractor(vit: str, mode: str, patch_size: int, device='cuda', dtype='bfloat16', compile_model=False):
     from extractors import DINOVitExtractor, CLIPVitExtractor
     model = {'dino': DINOVitExtractor, 'clip': CLIPVitExtractor}
-    vit_extractor = model[vit.lower()](patch_size=patch_size, mode=mode, device=device)
+    vit_extractor = model[vit.lower()](patch_size=patch_size, mode=mode, device=device, dtype=getattr(torch, dtype),
+                                       compile_model=compile_model)
 
     return vit_extractor
 